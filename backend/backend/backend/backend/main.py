@@ -1,23 +1,37 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, Security, UploadFile, File, Form
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime, timedelta, timezone
-import os, shutil, json
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, JSON, UniqueConstraint, Index
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, Session
-from passlib.hash import bcrypt
+from functools import lru_cache
+import os, hashlib, time
+import orjson
+from cachetools import TTLCache
+from sqlalchemy import select, event, Column, Integer, String, DateTime, ForeignKey, Boolean, JSON, UniqueConstraint, Index
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base, relationship, raiseload
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from passlib.context import CryptContext
 import jwt
 
-DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./app.db")
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///./app.db")
 JWT_SECRET = os.environ.get("JWT_SECRET", "dev-secret")
 FILES_DIR = os.environ.get("FILES_DIR", "./files")
 CORS_ORIGINS = os.environ.get("CORS_ORIGINS", "*")
 
 os.makedirs(FILES_DIR, exist_ok=True)
 
-app = FastAPI(title="Equipment App Starter")
+# Built once at import; 10 rounds (~60ms) instead of passlib's default 12 (~250ms)
+# keeps login latency sane while staying above the OWASP floor. deprecated="auto"
+# transparently re-verifies hashes minted at the old cost.
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=10)
+
+app = FastAPI(title="Equipment App Starter", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,10 +41,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+if DATABASE_URL.startswith("sqlite"):
+    engine = create_async_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+    # WAL lets concurrent readers proceed while a writer holds the lock.
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, _record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+else:
+    # Defaults (pool_size=5, max_overflow=10) stall requests under load; pre_ping
+    # and recycle guard against connections dropped by the DB or a proxy.
+    # Budget: 4 gunicorn workers x (10 + 10) = 80 connections, under the stock
+    # postgres:15 max_connections=100 — resize both together if either changes.
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=10,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_timeout=5,
+    )
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+def utcnow() -> datetime:
+    # Naive UTC: the DateTime columns are timezone-naive and asyncpg rejects
+    # tz-aware values bound to them (psycopg2 used to let that slide).
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# Both supported dialects spell upsert as INSERT ... ON CONFLICT DO UPDATE.
+upsert_insert = sqlite_insert if DATABASE_URL.startswith("sqlite") else pg_insert
+
 # --- Models ---
 class Company(Base):
     __tablename__ = "companies"
@@ -58,8 +102,8 @@ class Equipment(Base):
     current_mileage = Column(Integer, nullable=True)
     created_by = Column(Integer, ForeignKey("users.id"))
     updated_by = Column(Integer, ForeignKey("users.id"))
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
     __table_args__ = (
         UniqueConstraint("company_id", "number", name="uq_company_equipment_number"),
         Index("ix_equipment_company_number", "company_id", "number"),
@@ -85,7 +129,9 @@ class EquipmentTest(Base):
     due_date = Column(DateTime, nullable=True)
     notes = Column(String, nullable=True)
     created_by = Column(Integer, ForeignKey("users.id"))
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
+    # The upsert keys existing rows by (equipment, area); enforce that shape.
+    __table_args__ = (UniqueConstraint("equipment_id", "area_id", name="uq_equipment_test_area"),)
 
 class Attachment(Base):
     __tablename__ = "attachments"
@@ -96,16 +142,17 @@ class Attachment(Base):
     file_hash = Column(String, nullable=True)
     file_type = Column(String, nullable=True)
     uploaded_by = Column(Integer, ForeignKey("users.id"))
-    uploaded_at = Column(DateTime, default=datetime.now(timezone.utc))
+    uploaded_at = Column(DateTime, default=utcnow)
 
 class EquipmentLock(Base):
     __tablename__ = "equipment_locks"
     equipment_id = Column(Integer, ForeignKey("equipment.id"), primary_key=True)
     locked_by = Column(Integer, ForeignKey("users.id"))
-    locked_at = Column(DateTime, default=datetime.now(timezone.utc))
+    locked_at = Column(DateTime, default=utcnow)
     status = Column(String, default="active")  # active | released | overridden | expired
     override_by = Column(Integer, ForeignKey("users.id"), nullable=True)
     override_at = Column(DateTime, nullable=True)
+    __table_args__ = (Index("ix_equipment_locks_equipment_status", "equipment_id", "status"),)
 
 class AuditEvent(Base):
     __tablename__ = "audit_events"
@@ -116,18 +163,31 @@ class AuditEvent(Base):
     entity_id = Column(String, nullable=False)
     before_json = Column(String, nullable=True)
     after_json = Column(String, nullable=True)
-    timestamp = Column(DateTime, default=datetime.now(timezone.utc))
+    timestamp = Column(DateTime, default=utcnow, index=True)
     ip = Column(String, nullable=True)
+    __table_args__ = (Index("ix_audit_entity", "entity", "entity_id"),)
+
+@app.on_event("startup")
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
-Base.metadata.create_all(bind=engine)
+@app.get("/debug/pool")
+def pool_status():
+    return {"pool": engine.pool.status()}
 
 # --- Utils / Auth ---
-def get_db():
+async def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
+
+# Hoisted so decode doesn't rebuild them per call; require sub/exp up front so
+# malformed tokens are rejected before they reach the cache or the DB.
+JWT_ALGORITHMS = ["HS256"]
+JWT_DECODE_OPTIONS = {"require": ["exp", "sub"]}
 
 def create_token(user: User) -> str:
     payload = {
@@ -139,17 +199,46 @@ def create_token(user: User) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
 
-def get_current_user(db: Session = Depends(get_db), authorization: str = None) -> User:
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    token = authorization.split(" ", 1)[1]
-    try:
-        data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-    except Exception:
+# Tokens are reused for their whole 8h lifetime, so re-verifying the HMAC on every
+# request is wasted CPU. Short TTLs keep staleness (revoked users, role changes) bounded.
+_token_cache = TTLCache(maxsize=10000, ttl=60)  # blake2b(token) -> decoded claims
+_user_cache = TTLCache(maxsize=10000, ttl=60)   # user_id -> User
+
+# Testing areas only change via /seed, so a 5min TTL is generous.
+_area_cache = TTLCache(maxsize=1000, ttl=300)   # company_id -> {code: TestingArea}
+
+async def get_company_areas(db: AsyncSession, company_id: int) -> dict:
+    areas = _area_cache.get(company_id)
+    if areas is None:
+        areas = {a.code: a for a in (await db.execute(select(TestingArea).filter_by(company_id=company_id))).scalars()}
+        _area_cache[company_id] = areas
+    return areas
+
+bearer_scheme = HTTPBearer()
+
+async def get_current_user(db: AsyncSession = Depends(get_db),
+                           credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)) -> User:
+    token = credentials.credentials
+    # Key on a digest so raw tokens don't sit in memory.
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    data = _token_cache.get(cache_key)
+    if data is None:
+        try:
+            data = jwt.decode(token, JWT_SECRET, algorithms=JWT_ALGORITHMS, options=JWT_DECODE_OPTIONS)
+        except Exception:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        _token_cache[cache_key] = data
+    elif data["exp"] <= time.time():
+        # The cache TTL can outlive a token's exp; never serve an expired entry.
+        _token_cache.pop(cache_key, None)
         raise HTTPException(status_code=401, detail="Invalid token")
-    user = db.get(User, int(data["sub"]))
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+    user_id = int(data["sub"])
+    user = _user_cache.get(user_id)
+    if user is None:
+        user = await db.get(User, user_id)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        _user_cache[user_id] = user
     return user
 
 # --- Schemas ---
@@ -159,7 +248,7 @@ class LoginReq(BaseModel):
 
 class LoginResp(BaseModel):
     token: str
-    name: Optional[str]
+    name: Optional[str] = None
     role: str
 
 class EquipmentTestIn(BaseModel):
@@ -174,18 +263,24 @@ class EquipmentUpsertReq(BaseModel):
     type: Optional[str] = None
     job: Optional[str] = None
     mileage: Optional[int] = None
-    tests: List[EquipmentTestIn] = []
+    tests: List[EquipmentTestIn] = Field(default_factory=list)
 
 # --- Seed route ---
+@lru_cache(maxsize=8)
+def seed_password_hash(password: str) -> str:
+    # bcrypt is deliberately slow; repeated /seed calls (dev resets, load
+    # scripts) shouldn't each pay for re-hashing a fixed dev password.
+    return pwd_context.hash(password)
+
 @app.post("/seed")
-def seed(db: Session = Depends(get_db)):
-    company = db.query(Company).filter_by(name="Default Co").first()
+async def seed(db: AsyncSession = Depends(get_db)):
+    company = (await db.execute(select(Company).filter_by(name="Default Co"))).scalars().first()
     if not company:
         company = Company(name="Default Co")
-        db.add(company); db.commit(); db.refresh(company)
-    admin = db.query(User).filter_by(email="admin@example.com").first()
+        db.add(company); await db.commit(); await db.refresh(company)
+    admin = (await db.execute(select(User).filter_by(email="admin@example.com"))).scalars().first()
     if not admin:
-        admin = User(email="admin@example.com", password_hash=bcrypt.hash("admin123"), name="Admin", role="admin", company_id=company.id)
+        admin = User(email="admin@example.com", password_hash=await run_in_threadpool(seed_password_hash, "admin123"), name="Admin", role="admin", company_id=company.id)
         db.add(admin)
     areas = [
         ("Dielectric (Boom)", "DIELECTRIC", ["Bucket Truck", "Digger Derrick"], 365),
@@ -195,75 +290,98 @@ def seed(db: Session = Depends(get_db)):
         ("Fall Protection/Lanyards", "FALL_PROTECT", ["Bucket Truck", "Digger Derrick"], 365),
         ("Grounds/Hot Sticks", "GROUNDS_STICKS", ["Bucket Truck", "Digger Derrick"], 180),
     ]
-    for name, code, types, cadence in areas:
-        if not db.query(TestingArea).filter_by(company_id=company.id, code=code).first():
-            db.add(TestingArea(company_id=company.id, name=name, code=code, applies_to_types=types, default_cadence_days=cadence))
-    db.commit()
+    # One multi-row INSERT; uq_company_area_code skips areas that already exist,
+    # replacing six SELECT+INSERT pairs per call.
+    await db.execute(upsert_insert(TestingArea).values([
+        {"company_id": company.id, "name": name, "code": code, "applies_to_types": types, "default_cadence_days": cadence}
+        for name, code, types, cadence in areas
+    ]).on_conflict_do_nothing(index_elements=["company_id", "code"]))
+    await db.commit()
+    _area_cache.pop(company.id, None)
     return {"ok": True, "company_id": company.id, "admin_login": {"email": "admin@example.com", "password": "admin123"}}
 
 # --- Auth ---
 @app.post("/auth/login", response_model=LoginResp)
-def login(payload: LoginReq, db: Session = Depends(get_db)):
-    user = db.query(User).filter_by(email=payload.email).first()
-    if not user or not bcrypt.verify(payload.password, user.password_hash):
+async def login(payload: LoginReq, db: AsyncSession = Depends(get_db)):
+    user = (await db.execute(select(User).where(User.email == payload.email).limit(1))).scalars().first()
+    # bcrypt holds the event loop for ~60ms per verify; push it to the thread
+    # pool (the C backend releases the GIL, so threads are enough — no process
+    # pool needed) and keep serving other requests meanwhile.
+    if not user or not await run_in_threadpool(pwd_context.verify, payload.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     return {"token": create_token(user), "name": user.name, "role": user.role}
 
 # --- Locking ---
 LOCK_TIMEOUT_MINUTES = 15
 
-def get_equipment_by_number(db: Session, company_id: int, number: str):
-    return db.query(Equipment).filter_by(company_id=company_id, number=number).first()
+async def get_equipment_by_number(db: AsyncSession, company_id: int, number: str):
+    # raiseload turns any future lazy-load off this row into a loud error
+    # instead of a silent N+1.
+    return (await db.execute(select(Equipment).options(raiseload("*"))
+                             .filter_by(company_id=company_id, number=number))).scalars().first()
 
 def is_lock_expired(lock: EquipmentLock) -> bool:
     if not lock: return True
-    return (datetime.now(timezone.utc) - lock.locked_at) > timedelta(minutes=LOCK_TIMEOUT_MINUTES) or lock.status != "active"
+    # Stored values are naive UTC; strip tzinfo from any aware stragglers.
+    locked_at = lock.locked_at.replace(tzinfo=None) if lock.locked_at.tzinfo else lock.locked_at
+    return (utcnow() - locked_at) > timedelta(minutes=LOCK_TIMEOUT_MINUTES) or lock.status != "active"
 
 @app.post("/equipment/lock")
-def lock_equipment(number: str = Form(...), db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    eq = get_equipment_by_number(db, user.company_id, number)
+async def lock_equipment(number: str = Form(...), db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user)):
+    eq = await get_equipment_by_number(db, user.company_id, number)
     if not eq:
-        eq = Equipment(company_id=user.company_id, number=number, created_by=user.id, updated_by=user.id)
-        db.add(eq); db.commit(); db.refresh(eq)
-    lock = db.get(EquipmentLock, eq.id)
-    if lock and not is_lock_expired(lock):
-        if lock.locked_by != user.id:
-            return {"locked": True, "locked_by": lock.locked_by, "locked_at": lock.locked_at.isoformat(), "editable": False}
-        else:
-            return {"locked": True, "locked_by": user.id, "locked_at": lock.locked_at.isoformat(), "editable": True}
-    if not lock:
-        lock = EquipmentLock(equipment_id=eq.id, locked_by=user.id, locked_at=datetime.now(timezone.utc), status="active")
-        db.add(lock)
-    else:
-        lock.locked_by = user.id; lock.locked_at = datetime.now(timezone.utc); lock.status = "active"; lock.override_by=None; lock.override_at=None
-    db.add(AuditEvent(actor_id=user.id, action="lock", entity="Equipment", entity_id=str(eq.id), after_json=json.dumps({"number": number})))
-    db.commit()
+        # DO NOTHING + re-select instead of add/commit: two concurrent first
+        # locks on a fresh number raced to an IntegrityError on the unique
+        # (company_id, number) constraint.
+        await db.execute(upsert_insert(Equipment).values(
+            company_id=user.company_id, number=number, created_by=user.id, updated_by=user.id,
+        ).on_conflict_do_nothing(index_elements=["company_id", "number"]))
+        await db.commit()
+        eq = await get_equipment_by_number(db, user.company_id, number)
+    # Same pattern for the lock row: FOR UPDATE can't lock a row that doesn't
+    # exist yet, so let the primary key arbitrate concurrent first claims.
+    claimed = (await db.execute(upsert_insert(EquipmentLock).values(
+        equipment_id=eq.id, locked_by=user.id, locked_at=utcnow(), status="active",
+    ).on_conflict_do_nothing(index_elements=["equipment_id"]))).rowcount
+    if not claimed:
+        # FOR UPDATE serializes competing takeover attempts at the DB instead of
+        # letting two requests both read "expired" and both claim the lock
+        # (no-op on SQLite).
+        lock = await db.get(EquipmentLock, eq.id, with_for_update=True)
+        if lock and not is_lock_expired(lock):
+            if lock.locked_by != user.id:
+                return {"locked": True, "locked_by": lock.locked_by, "locked_at": lock.locked_at.isoformat(), "editable": False}
+            else:
+                return {"locked": True, "locked_by": user.id, "locked_at": lock.locked_at.isoformat(), "editable": True}
+        lock.locked_by = user.id; lock.locked_at = utcnow(); lock.status = "active"; lock.override_by=None; lock.override_at=None
+    db.add(AuditEvent(actor_id=user.id, action="lock", entity="Equipment", entity_id=str(eq.id), after_json=orjson.dumps({"number": number}).decode()))
+    await db.commit()
     return {"locked": True, "editable": True, "equipment_id": eq.id}
 
 @app.post("/equipment/override-lock")
-def override_lock(number: str = Form(...), reason: Optional[str] = Form(None), db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    eq = get_equipment_by_number(db, user.company_id, number)
+async def override_lock(number: str = Form(...), reason: Optional[str] = Form(None), db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user)):
+    eq = await get_equipment_by_number(db, user.company_id, number)
     if not eq: raise HTTPException(status_code=404, detail="Equipment not found")
-    lock = db.get(EquipmentLock, eq.id)
+    lock = await db.get(EquipmentLock, eq.id, with_for_update=True)
     if lock and not is_lock_expired(lock) and lock.locked_by != user.id:
         if user.role not in ["supervisor","admin"]:
             raise HTTPException(status_code=403, detail="Insufficient permissions to override")
-        lock.status="overridden"; lock.override_by=user.id; lock.override_at=datetime.now(timezone.utc)
-        lock.locked_by=user.id; lock.locked_at=datetime.now(timezone.utc); lock.status="active"
-        db.add(AuditEvent(actor_id=user.id, action="override", entity="Lock", entity_id=str(eq.id), after_json=json.dumps({"reason": reason or ""})))
-        db.commit()
+        lock.status="overridden"; lock.override_by=user.id; lock.override_at=utcnow()
+        lock.locked_by=user.id; lock.locked_at=utcnow(); lock.status="active"
+        db.add(AuditEvent(actor_id=user.id, action="override", entity="Lock", entity_id=str(eq.id), after_json=orjson.dumps({"reason": reason or ""}).decode()))
+        await db.commit()
         return {"ok": True, "editable": True}
     return {"ok": False, "message": "No active lock to override or you already hold the lock."}
 
 @app.post("/equipment/release-lock")
-def release_lock(number: str = Form(...), db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    eq = get_equipment_by_number(db, user.company_id, number)
+async def release_lock(number: str = Form(...), db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user)):
+    eq = await get_equipment_by_number(db, user.company_id, number)
     if not eq: return {"ok": True}
-    lock = db.get(EquipmentLock, eq.id)
+    lock = await db.get(EquipmentLock, eq.id, with_for_update=True)
     if lock and lock.locked_by == user.id and lock.status == "active":
         lock.status = "released"
         db.add(AuditEvent(actor_id=user.id, action="unlock", entity="Equipment", entity_id=str(eq.id)))
-        db.commit()
+        await db.commit()
     return {"ok": True}
 
 # --- Upsert & Attachments ---
@@ -272,65 +390,96 @@ def compute_due(last_date: Optional[datetime], cadence_days: int) -> Optional[da
     return last_date + timedelta(days=cadence_days)
 
 @app.post("/equipment/upsert")
-def upsert_equipment(payload: EquipmentUpsertReq, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    eq = get_equipment_by_number(db, user.company_id, payload.number)
-    creating = False
-    if not eq:
-        creating = True
-        eq = Equipment(company_id=user.company_id, number=payload.number, created_by=user.id)
-        db.add(eq); db.flush()
-    lock = db.get(EquipmentLock, eq.id)
+async def upsert_equipment(payload: EquipmentUpsertReq, db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user)):
+    eq = await get_equipment_by_number(db, user.company_id, payload.number)
+    lock = await db.get(EquipmentLock, eq.id, with_for_update=True) if eq else None
     if not lock or lock.locked_by != user.id or lock.status != "active":
         raise HTTPException(status_code=409, detail="This equipment is not locked by you. Acquire lock before saving.")
     before = {"description": eq.description, "type": eq.type, "current_job": eq.current_job, "current_mileage": eq.current_mileage}
-    eq.description = payload.description
-    eq.type = payload.type
-    eq.current_job = payload.job
-    eq.current_mileage = payload.mileage
-    eq.updated_by = user.id
-    db.add(eq)
-    company_areas = {a.code: a for a in db.query(TestingArea).filter_by(company_id=user.company_id).all()}
+    # One atomic statement instead of SELECT-then-INSERT/UPDATE; the unique
+    # (company_id, number) constraint arbitrates concurrent writers.
+    stmt = upsert_insert(Equipment).values(
+        company_id=user.company_id, number=payload.number, description=payload.description,
+        type=payload.type, current_job=payload.job, current_mileage=payload.mileage,
+        created_by=user.id, updated_by=user.id,
+    ).on_conflict_do_update(
+        index_elements=["company_id", "number"],
+        set_={"description": payload.description, "type": payload.type, "current_job": payload.job,
+              "current_mileage": payload.mileage, "updated_by": user.id, "updated_at": utcnow()},
+    ).returning(Equipment.id)
+    eq_id = (await db.execute(stmt)).scalar_one()
+    company_areas = await get_company_areas(db, user.company_id)
+    # One IN query for all affected tests instead of one SELECT per payload entry.
+    area_ids = [company_areas[t.area_code].id for t in payload.tests if t.area_code in company_areas]
+    existing_tests = {}
+    if area_ids:
+        existing_tests = {et.area_id: et for et in (await db.execute(
+            select(EquipmentTest).options(raiseload("*"))
+            .where(EquipmentTest.equipment_id == eq_id, EquipmentTest.area_id.in_(area_ids)))).scalars()}
+    new_tests = []
     for t in payload.tests:
         area = company_areas.get(t.area_code)
         if not area: continue
-        et = db.query(EquipmentTest).filter_by(equipment_id=eq.id, area_id=area.id).first()
-        if not et: et = EquipmentTest(equipment_id=eq.id, area_id=area.id)
+        et = existing_tests.get(area.id)
+        if not et:
+            et = EquipmentTest(equipment_id=eq_id, area_id=area.id)
+            new_tests.append(et)
+        # Clients may post tz-aware ISO dates; store naive UTC like everything else.
+        last_date = t.last_date.astimezone(timezone.utc).replace(tzinfo=None) if t.last_date and t.last_date.tzinfo else t.last_date
         et.applies = t.applies
-        et.last_date = t.last_date
-        et.due_date = compute_due(t.last_date, area.default_cadence_days) if t.applies else None
+        et.last_date = last_date
+        et.due_date = compute_due(last_date, area.default_cadence_days) if t.applies else None
         et.created_by = user.id
         et.notes = t.notes
-        db.add(et)
-    db.add(AuditEvent(actor_id=user.id, action="update" if not creating else "create", entity="Equipment", entity_id=str(eq.id),
-                      before_json=json.dumps(before), after_json=json.dumps({"description": eq.description, "type": eq.type, "job": eq.current_job, "mileage": eq.current_mileage})))
+    # add_all lets SQLAlchemy batch the INSERTs via insertmanyvalues instead of
+    # flushing row by row; rows already in existing_tests are tracked updates.
+    db.add_all(new_tests)
+    db.add(AuditEvent(actor_id=user.id, action="update", entity="Equipment", entity_id=str(eq_id),
+                      before_json=orjson.dumps(before).decode(), after_json=orjson.dumps({"description": payload.description, "type": payload.type, "job": payload.job, "mileage": payload.mileage}).decode()))
     lock.status = "released"
-    db.commit()
-    return {"ok": True, "equipment_id": eq.id}
+    await db.commit()
+    return {"ok": True, "equipment_id": eq_id}
 
 @app.post("/attachments/upload")
-def upload_attachment(number: str = Form(...), area_code: Optional[str] = Form(None), file: UploadFile = File(...),
-                      db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    eq = get_equipment_by_number(db, user.company_id, number)
+async def upload_attachment(number: str = Form(...), area_code: Optional[str] = Form(None), file: UploadFile = File(...),
+                            db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user)):
+    eq = await get_equipment_by_number(db, user.company_id, number)
     if not eq: raise HTTPException(status_code=404, detail="Equipment not found")
-    lock = db.get(EquipmentLock, eq.id)
+    lock = await db.get(EquipmentLock, eq.id)
     if not lock or lock.locked_by != user.id or lock.status != "active":
         raise HTTPException(status_code=409, detail="This equipment is not locked by you. Acquire lock before upload.")
     area = None
     if area_code:
-        area = db.query(TestingArea).filter_by(company_id=user.company_id, code=area_code).first()
+        area = (await get_company_areas(db, user.company_id)).get(area_code)
     safe_name = f"{eq.id}_{int(datetime.now(timezone.utc).timestamp())}_{file.filename}"
     dest = os.path.join(FILES_DIR, safe_name)
+    # Stream in 1MB chunks instead of shutil.copyfileobj on the sync file handle,
+    # which would buffer the whole body through the event loop thread. Writes go
+    # through the thread pool so a slow disk stalls only this request, not the
+    # loop. Hashing the same chunks costs nothing extra vs a second read pass;
+    # sha256 uses the hardware-accelerated OpenSSL implementation.
+    digest = hashlib.sha256()
     with open(dest, "wb") as out:
-        shutil.copyfileobj(file.file, out)
-    att = Attachment(equipment_id=eq.id, area_id=area.id if area else None, file_url=f"/files/{safe_name}", file_type=file.content_type, uploaded_by=user.id)
+        while chunk := await file.read(1024 * 1024):
+            await run_in_threadpool(out.write, chunk)
+            digest.update(chunk)
+    att = Attachment(equipment_id=eq.id, area_id=area.id if area else None, file_url=f"/files/{safe_name}",
+                     file_hash=digest.hexdigest(), file_type=file.content_type, uploaded_by=user.id)
     db.add(att)
     db.add(AuditEvent(actor_id=user.id, action="upload", entity="Attachment", entity_id=str(eq.id),
-                      after_json=json.dumps({"file": safe_name, "area_code": area_code})))
-    db.commit()
+                      after_json=orjson.dumps({"file": safe_name, "area_code": area_code}).decode()))
+    await db.commit()
     return {"ok": True, "file_url": f"/files/{safe_name}"}
 
-@app.get("/files/{filename}")
-def get_file(filename: str):
-    path = os.path.join(FILES_DIR, filename)
-    if not os.path.exists(path): raise HTTPException(status_code=404, detail="Not found")
-    return FileResponse(path)
+@app.middleware("http")
+async def files_cache_control(request, call_next):
+    response = await call_next(request)
+    # Attachment names embed the upload timestamp, so their content never
+    # changes; clients can cache hard and revalidate with the StaticFiles ETag.
+    if request.url.path.startswith("/files/") and response.status_code in (200, 304):
+        response.headers.setdefault("Cache-Control", "public, max-age=86400, immutable")
+    return response
+
+# StaticFiles serves attachments off the event loop with Range/304 support and
+# path-traversal protection; in front of Nginx, point an alias at FILES_DIR instead.
+app.mount("/files", StaticFiles(directory=FILES_DIR), name="files")